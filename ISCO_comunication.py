@@ -1,9 +1,9 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 """
 Two way communication program for taking readings from and controlling an ISCO Pump controller.
 Uses an external USB to RS485 converter that is connected to the DB25 on the ISCO controller.
 
-Written for python2.7
+Written for python 3.7+ (originally python2.7)
 
 Company: Interface Fluidics
 Written by: Stuart de Haas
@@ -12,35 +12,85 @@ Created: March 08, 2017
 
 import serial 
 import serial.tools.list_ports
-import struct #Used to convert readings to floating point
+import struct # Used to build the data stream request and convert readings to floating point
 import time # Used for delays
 from time import gmtime, strftime # Used for real time clock
+from time import monotonic # Used to keep the time between readings steady
 import logging # Used to output data and info to file and console
-import thread # Used to take input while outputting data stream
+# Used to write the log from a background thread so the readings aren't held up
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+import threading # Used to take input while outputting data stream
+import os
 import os.path
+import json # Used to remember the last port that worked
 import sys
+import ctypes # Used for Windows thread priority and timer resolution
 
 # modbus must be installed manually on the computer. Try 'pip install modbus_tk' or google it
 import modbus_tk
 import modbus_tk.defines as cst
+import modbus_tk.utils
 from modbus_tk import modbus_rtu
 
 # Change the frequency at which readings are taken
 SAMPLE_FREQ = 0.5 # Hz
 
+# When logging to a file every reading is saved to a binary '.bin' file next to the log.
+# Only every Nth reading is then written to the text log/console as a check that it's working
+TEXT_LOG_EVERY = 10
+
 # debug mode allows the program to run without being connected to the pumps.
 # Not all functionality can be tested but it can be usefull 
 DEBUG_MODE = False
 
+# The port that last connected to the ISCO is saved here and tried first next time
+LAST_PORT_FILE = os.path.expanduser('~/.isco_last_port.json')
+
 # Keep Track of software version
 SOFTWARE_VERSION = 'V1.0; Last Update: 2017-March-10'
-INTERRUPT_FLAG = False
+STOP_EVENT = threading.Event() # Set to stop the data stream
+LOG_LISTENER = None # Background thread that writes the log, see StartLogging
+DATA_FILE = None # Binary file that every reading is saved to, see logReadings
+# Modbus RTU silent interval between frames: 3.5 characters of 11 bits each.
+# Updated to match the baud rate when connecting. If the ISCO starts missing
+# requests try making this longer (20ms should be plenty)
+SILENT_INTERVAL = 3.5 * 11 / 19200.0 # seconds
 
 # Address used for reading/writing data
 #CURRENT_PRESSURE_START_ADDRESS = 72 #Start at the address for Pressure of pump A.
 #BYTES_TO_READ = 10 # 5 32bit numbers, volume A remaining is not used
 #UNITS_ADDRESS = 84 # Address of registers containing the units being used
 
+# Units indexed by the 4 unit bits of each type read as a number (see ReadUnits)
+# Anything other than a single bit being set is unknown: '?'
+PRESSURE_UNITS = ('?', 'ATM', 'BAR', '?', 'kPa', '?', '?', '?', 'PSI', '?', '?', '?', '?', '?', '?', '?')
+FLOW_UNITS = ('?', 'ml/min', 'ml/hr', '?', 'ul/min', '?', '?', '?', 'ul/hr', '?', '?', '?', '?', '?', '?', '?')
+
+# Formats used to unpack holding registers directly into 32-bit big-endian floats
+# Each float is two 16-bit registers and 'x' skips a byte we don't care about
+STREAM_FORMAT = '>ff4xff' # Pressure A, Flow A, (Volume A), Pressure B, Flow B
+MAX_SETTINGS_FORMAT = '>ff24xff' # Max Pressure A, B, (unused), Max Flow A, B
+
+# The data stream request never changes so the RTU frame is built once here:
+# device address 1, read holding registers, start address 72, 10 registers, CRC
+STREAM_REQUEST = struct.pack('>BBHH', 1, cst.READ_HOLDING_REGISTERS, 72, 10)
+STREAM_REQUEST += struct.pack('>H', modbus_tk.utils.calculate_crc(STREAM_REQUEST))
+# Response: device address, function, byte count, 20 data bytes, CRC
+STREAM_RESPONSE_HEADER = struct.pack('>BBB', 1, cst.READ_HOLDING_REGISTERS, 20)
+STREAM_RESPONSE_LENGTH = 25
+STREAM_STRUCT = struct.Struct(STREAM_FORMAT)
+CRC_STRUCT = struct.Struct('>H')
+MAX_SETTINGS_STRUCT = struct.Struct(MAX_SETTINGS_FORMAT)
+
+# Tab seperated line for each reading: Pressure A, Flow Rate A, Pressure B, Flow Rate B
+# Time stamps are added by the logger
+READING_FORMAT = "%f\t%f\t%f\t%f"
+
+# Binary record for each reading: time in ns since the epoch (little-endian unsigned 64-bit)
+# then Pressure A, Flow Rate A, Pressure B, Flow Rate B as 32-bit floats. 24 bytes per reading
+DATA_RECORD = struct.Struct('<Q4f')
+
 
 def setup():
     """Run initialization of system and connect to controller.
@@ -55,15 +105,17 @@ def setup():
     print("\n\nHello and welcome to the ISCO Pump communication program!")
     print("Interface Fluidics\n")
 
+    global DATA_FILE, SILENT_INTERVAL
+
     test_date = strftime("%Y%m%d")
     record_format = "%(asctime)s\t%(name)s\t%(levelname)s\t%(message)s"
 
     while True:
-        cmd = raw_input("Would you like to log the data to a file? (y)es or (n)o?\n")
+        cmd = input("Would you like to log the data to a file? (y)es or (n)o?\n")
         if cmd == 'y':
             # Loop until a vailid file name is selected
             while True:
-                name_of_test = raw_input("Please provide a filename suffix: ")
+                name_of_test = input("Please provide a filename suffix: ")
                 # Start a log to keep track of stuff
                 log_name = "log_files\\" + test_date + '_' + name_of_test+'.log'
                 if os.path.exists(log_name):
@@ -73,24 +125,30 @@ def setup():
                     break
             print("Your log name will be: "+ log_name + '\n')
 
-            # Create a logger for outputting to a file
-            logging.basicConfig(filename=log_name, format=record_format, datefmt='%I:%M:%S %p', level=logging.DEBUG)
+            # Every reading is also saved to a binary file, see ReadDataFile to get them back
+            DATA_FILE = open(log_name + '.bin', 'wb', buffering=0)
 
-            # Then create a second logger to output to the console
+            # Create a handler for outputting to a file
+            file_handler = BufferedFileHandler(log_name)
+            file_handler.setFormatter(logging.Formatter(record_format, datefmt='%I:%M:%S %p'))
+
+            # Then create a second handler to output to the console
             console = logging.StreamHandler()
             console.setLevel(logging.INFO)
             # set a format which is simpler for console use
             formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
             # tell the handler to use this format
             console.setFormatter(formatter)
-            # add the handler to the root logger
-            logging.getLogger('').addHandler(console)
+
+            StartLogging([file_handler, console], logging.DEBUG)
             break
 
         elif cmd =='n':
             # If no output file is wanted then output to the console only
-            # Set level=logging.DEBUG for more info
-            logging.basicConfig(format=record_format, level=logging.INFO)
+            console = logging.StreamHandler()
+            console.setFormatter(logging.Formatter(record_format))
+            # Set logging.DEBUG for more info
+            StartLogging([console], logging.INFO)
             break
         else:
             print("Invalid Response")
@@ -106,19 +164,28 @@ def setup():
     print("Let's connect to the ISCO Controller...")
 
     
+    # Try the port that worked last time first so there's no need to ask
+    choice = LoadLastPort()
+
     # Keep trying to connect to the controller until it works or they exit
     while True:
-        # Generate a list of USB ports
-        ports = list(serial.tools.list_ports.comports())
-        print("Available Ports:")
-        for p in ports:
-            print(p)
+        if choice is None:
+            # Generate a list of USB ports
+            ports = list(serial.tools.list_ports.comports())
+            print("Available Ports:")
+            for p in ports:
+                print(p)
+
+            choice = input("\nWhich port would you like to try? i.e. 'COM6' (or (e)xit)\n")
+        else:
+            print("Trying last used port " + choice)
 
-        choice = raw_input("\nWhich port would you like to try? i.e. 'COM6' (or (e)xit)\n")
         if choice == "e":
+            StopLogging()
             sys.exit() # Exits without doing anything else
         else:
 
+            ser = None
             try:
                 # In debug mode the connection step is skipped so it works without an ISCO
                 if DEBUG_MODE == True:
@@ -126,23 +193,47 @@ def setup():
                     return True
 
                 #Connect to the slave
-                master = modbus_rtu.RtuMaster(
-                serial.Serial(port=choice, baudrate=19200, bytesize=8, parity=serial.PARITY_EVEN, stopbits=1, xonxoff=0)
-                )
-                master.set_timeout(5.0)
+                ser = serial.Serial(port=choice, baudrate=19200, bytesize=8, parity=serial.PARITY_EVEN, stopbits=1, xonxoff=0)
+                # The USB converter holds short responses for up to 16ms before passing them on.
+                # Drop this to 1ms so each reading comes back as soon as the ISCO answers
+                try:
+                    ser.set_low_latency_mode(True)
+                except (AttributeError, NotImplementedError, IOError, ValueError):
+                    # Only supported on Linux. On Windows set 'Latency Timer' to 1 in the
+                    # advanced port settings of the FTDI driver instead
+                    pass
+                master = modbus_rtu.RtuMaster(ser)
+                SILENT_INTERVAL = 3.5 * 11 / float(ser.baudrate)
+                # modbus_tk stops reading as soon as the expected length of a response is in,
+                # so the timeout only matters when the ISCO doesn't answer. A reading takes
+                # ~20ms on the line plus the ISCO's turnaround and up to 16ms of USB latency
+                master.set_timeout(0.2)
                 master.set_verbose(False) # Set to 'True' for more descriptive output
-                on_A, on_B = CheckIfOn(master) # Just to check if it's working
+                on_A, on_B = CheckIfOn(ReadAllCoils(master)) # Just to check if it's working
                 #logging.info("connected to port " + choice)
-                # If the port works, break from loop
+                # If the port works, remember it and break from loop
+                SaveLastPort(choice)
                 break
-            except modbus_tk.exceptions.ModbusInvalidResponseError as exc:
-                #Modbus recieved an invalid response. Occurs when nothing is connected
+            except (modbus_tk.exceptions.ModbusInvalidResponseError, modbus_tk.exceptions.ModbusError) as exc:
+                #Modbus recieved an invalid response (occurs when nothing is connected)
+                #or the device answered with a modbus exception
                 print("Invalid response from " + choice + ".\n\nPlease try again.")
+                # Release the port, otherwise trying it again fails with 'port already open'
+                master.close()
+                # Only forget the saved port if it's the one that failed
+                if choice == LoadLastPort():
+                    ForgetLastPort()
+                choice = None
                 continue
-            except:
-                # If anything else fails during connection, let them try again
-                print ("Unexpected error:", sys.exc_info()[0])
+            except OSError as exc:
+                # If the port can't be opened or used, let them try again
+                # (serial.SerialException is an OSError)
+                print(f"Open failed: {exc}")
+                # Release the port if it did open, otherwise trying it again fails with 'port already open'
+                if ser is not None:
+                    ser.close()
                 print("\n\nTry Again")
+                choice = None
                 continue
 
 
@@ -151,17 +242,118 @@ def setup():
     return master # return the ISCO controller serial connection 'object'
 
 
+class BufferedFileHandler(logging.FileHandler):
+    """FileHandler that keeps records in the file buffer rather than writing out each one.
+
+    A normal FileHandler flushes after every record, which is a disk write for every
+    reading. Here the buffer is written out every 'flush_interval' seconds by a
+    background thread and when the handler is closed, so at most about a second of
+    the log is lost if the program crashes."""
+
+    def __init__(self, filename, flush_interval=1.0):
+        logging.FileHandler.__init__(self, filename)
+        self.flush_interval = flush_interval
+        self.closed_event = threading.Event()
+        threading.Thread(target=self.FlushLoop, daemon=True).start()
+
+    def flush(self):
+        # Called after every record, leave it in the buffer
+        pass
+
+    def WriteToDisk(self):
+        """Write out whatever is in the file buffer"""
+        logging.FileHandler.flush(self)
+
+    def FlushLoop(self):
+        while not self.closed_event.wait(self.flush_interval):
+            self.WriteToDisk()
+
+    def close(self):
+        self.closed_event.set()
+        self.WriteToDisk()
+        logging.FileHandler.close(self)
+
+
+class RecordQueueHandler(QueueHandler):
+    """QueueHandler that puts records on the queue as they are.
+
+    The standard QueueHandler formats the message in the calling thread so the record
+    can be pickled. The queue never leaves this process, so the formatting is left for
+    the QueueListener thread to do."""
+
+    def prepare(self, record):
+        return record
+
+
+def StartLogging(handlers, level):
+    """Attach the handlers to the root logger through a queue.
+
+    The data stream logs from its own thread. Rather than have that thread format
+    and write every record itself, records are put on a queue and a QueueListener
+    thread passes them on to the file/console handlers."""
+
+    global LOG_LISTENER
+
+    root = logging.getLogger('')
+    root.setLevel(level)
+
+    log_queue = SimpleQueue()
+    root.addHandler(RecordQueueHandler(log_queue))
+    LOG_LISTENER = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    LOG_LISTENER.start()
+
+
+def StopLogging():
+    """Write out anything left in the log queue, stop the listener thread and close the data file"""
+
+    global LOG_LISTENER, DATA_FILE
+
+    if DATA_FILE is not None:
+        DATA_FILE.close()
+        DATA_FILE = None
+
+    if LOG_LISTENER is not None:
+        LOG_LISTENER.stop()
+        LOG_LISTENER = None
+
+
+def LoadLastPort():
+    """Return the port that last connected to the ISCO, or None if there isn't one saved"""
+
+    try:
+        with open(LAST_PORT_FILE) as port_file:
+            return json.load(port_file)['port']
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+def SaveLastPort(port):
+    """Remember a port that connected to the ISCO so it's tried first next time"""
+
+    try:
+        with open(LAST_PORT_FILE, 'w') as port_file:
+            json.dump({'port': port}, port_file)
+    except IOError:
+        logging.debug("Could not save the port to " + LAST_PORT_FILE)
+
+
+def ForgetLastPort():
+    """Delete the saved port, i.e. when the ISCO no longer answers on it"""
+
+    if os.path.exists(LAST_PORT_FILE):
+        os.remove(LAST_PORT_FILE)
+
+
 def ListPumpSettings(master):
     """ Read from ISCO Controller then output Max Pressures, Max Flowrates and if pumps are on or off"""
 
-    # Need a delay between readings otherwise the ISCO can't keep up
-    time.sleep(0.2)
-    PRESSURE_UNIT, FLOW_UNIT = ReadUnits(master)
-    time.sleep(0.2)
+    coils = ReadAllCoils(master)
+    # Only wait the modbus RTU silent interval between frames
+    time.sleep(SILENT_INTERVAL)
     pressure_A, flowRate_A, pressure_B, flowRate_B = CheckMaxPressureFlow(master)
-    time.sleep(0.2)
-    on_A, on_B = CheckIfOn(master)
-    time.sleep(0.2)
+
+    PRESSURE_UNIT, FLOW_UNIT = ReadUnits(coils)
+    on_A, on_B = CheckIfOn(coils)
 
     # Output current ISCO settings to file/header
     logging.info("Pressure Unit: " + PRESSURE_UNIT + "; Flow Rate Unit: " + FLOW_UNIT)
@@ -169,46 +361,42 @@ def ListPumpSettings(master):
     logging.info("Max Flow Rate -> Pump A: " + str(flowRate_A) + FLOW_UNIT + ", Pump B: " + str(flowRate_B) + FLOW_UNIT)
     logging.info("Pump A is " + on_A + ", Pump B is " + on_B)
 
-    global INTERRUPT_FLAG
-    INTERRUPT_FLAG = False
+    STOP_EVENT.clear()
 
 
-def ReadUnits(master):
-    """Reads the current units from the ISCO controller"""
+def ReadAllCoils(master):
+    """Read every coil the program uses from the ISCO controller in one request.
 
-    # Read from device (device address 1, command, coil address 84, 8 bits to read)
+    The pump status (coils 0-1) and the units (coils 84-91) are both in the coil
+    table so it's quicker to grab all 92 bits at once than to ask for each separately."""
+
+    # Read from device (device address 1, command, coil address 0, 92 bits to read)
     # Refer to ISCO controller Section on modbus protocol and/or the online resources
-    # Outputs a tuple of bits (actually ints I think) that indicate 
-    # True/False for the current units
-    unit_byte = master.execute(1, cst.READ_COILS, 84, 8)
+    # Outputs a tuple of bits (actually ints I think) that indicate True/False
+    return master.execute(1, cst.READ_COILS, 0, 92)
+
+
+def ReadUnits(coils):
+    """Get the current units from the coils read by ReadAllCoils"""
+
+    # The units are in coils 84 to 91
+    unit_byte = coils[84:92]
 
     # example output: unit_byte = [0, 1, 0, 0, 1, 0, 0, 0]
     # unit_byte[1] == 1 (same as == True) 
     # this means the units are in 'BAR'
-    if unit_byte[0]:
-        PRESSURE_UNIT = 'ATM'
-    elif unit_byte[1]:
-        PRESSURE_UNIT = 'BAR'
-    elif unit_byte[2]:
-        PRESSURE_UNIT = 'kPa'
-    elif unit_byte[3]:
-        PRESSURE_UNIT = 'PSI'
-
-    if unit_byte[4]:
-        FLOW_UNIT = 'ml/min'
-    elif unit_byte[5]:
-        FLOW_UNIT = 'ml/hr'
-    elif unit_byte[6]:
-        FLOW_UNIT = 'ul/min'
-    elif unit_byte[7]:
-        FLOW_UNIT = 'ul/hr'
+    # Only one bit of each group of 4 is set so turn each group into a number
+    # and look the unit up in a table - i.e. [0, 1, 0, 0] -> 0b0010 -> 'BAR'
+    PRESSURE_UNIT = PRESSURE_UNITS[unit_byte[0] | unit_byte[1] << 1 | unit_byte[2] << 2 | unit_byte[3] << 3]
+    FLOW_UNIT = FLOW_UNITS[unit_byte[4] | unit_byte[5] << 1 | unit_byte[6] << 2 | unit_byte[7] << 3]
 
     return PRESSURE_UNIT, FLOW_UNIT
     
-def CheckIfOn(master):
-    """ Check the status registers to see which pumps are running """
+def CheckIfOn(coils):
+    """ Check the status coils read by ReadAllCoils to see which pumps are running """
 
-    pump_status = master.execute(1, cst.READ_COILS, 0, 2)
+    # The run status of pumps A and B are coils 0 and 1
+    pump_status = coils[0:2]
 
     if pump_status[0]:
         pumpA = 'on'
@@ -225,55 +413,66 @@ def CheckIfOn(master):
 def CheckMaxPressureFlow(master):
     """ Check the maximum pressure and flow rate settings """
 
-    readings = master.execute(1, cst.READ_HOLDING_REGISTERS, 32, 20)
-
-    # holding register readings come as two 16-bit integers that represent 
-    # a 32-bit floating point number. They must be converted!
-    pressure_A = TupleToFloat(readings[0:2])
-    pressure_B = TupleToFloat(readings[2:4])
-    flowRate_A = TupleToFloat(readings[16:18])
-    flowRate_B = TupleToFloat(readings[18:20])
+    # holding register readings come as pairs of 16-bit integers that represent
+    # a 32-bit floating point number. Get the raw bytes from modbus_tk and unpack
+    # them straight to floats with the precompiled MAX_SETTINGS_STRUCT
+    data = master.execute(1, cst.READ_HOLDING_REGISTERS, 32, 20, returns_raw=True)
+    pressure_A, pressure_B, flowRate_A, flowRate_B = MAX_SETTINGS_STRUCT.unpack_from(data)
 
     return [pressure_A, flowRate_A, pressure_B, flowRate_B]
 
-def TupleToFloat(tup):
-    """ Convert two 16bit ints to a 32 bit IEEE 754 floating point """
 
-    # 'a' is first 16-bits and 'b' is the next 16-bits
-    a,b = tup[0], tup[1]
-    # bit-shift 'a' and concatenate with 'b'
-    # i.e. let: a=0b0010, b=0b0110
-    # a<<4 == 0b00100000 (move each bit left 4 places)
-    # a + b = 0b00100110 (combine a and b, same as addition) 
-    num = (a << 16) + b
-    # interpret this 32-bit number as a float (not the same as type casting)
-    # look it up on Wiki if you don't know how floats work
-    output = struct.unpack('f', struct.pack('I', num))[0]
-    # Output a floating point number 
-    return(output)
+def MakeStreamReader(master):
+    """Return a function that reads the pressure and flow rates, for use in the data stream loop.
 
-
-def ReadRegisters(master):
-    """Read the pressure and flow rate registers for pumps A and B then return as floats"""
+    The returned function sends the prebuilt data stream request straight to the serial
+    port and unpacks the response. This skips modbus_tk for the one request that is
+    repeated for every reading, everything else still goes through master.execute. The serial
+    port methods and formats are looked up once here instead of on every reading."""
 
     # If we are in debug mode then just output this data for testing purposes
     if DEBUG_MODE == True:
-        return [5.67, (-6.3), 7.0, 8.99]
-
-    readings = master.execute(1, cst.READ_HOLDING_REGISTERS, 72, 10)
-    pressure_A = TupleToFloat(readings[0:2])
-    flowRate_A = TupleToFloat(readings[2:4])
-    pressure_B = TupleToFloat(readings[6:8])
-    flowRate_B = TupleToFloat(readings[8:10])
-
-    return [pressure_A, flowRate_A, pressure_B, flowRate_B]
+        return lambda: (5.67, (-6.3), 7.0, 8.99)
+
+    reset_input_buffer = master._serial.reset_input_buffer
+    write = master._serial.write
+    read = master._serial.read
+    calculate_crc = modbus_tk.utils.calculate_crc
+    pack_crc = CRC_STRUCT.pack
+    unpack_from = STREAM_STRUCT.unpack_from
+    request = STREAM_REQUEST
+    header = STREAM_RESPONSE_HEADER
+    length = STREAM_RESPONSE_LENGTH
+    timeout = master._serial.timeout
+
+    def ReadStream():
+        # Throw away any stale bytes so they aren't mistaken for the response
+        reset_input_buffer()
+        write(request)
+        response = read(length)
+        # The response can arrive in pieces (i.e. split across USB packets) so keep
+        # reading until all of it is in or the timeout runs out
+        if len(response) < length:
+            deadline = monotonic() + timeout
+            while len(response) < length and monotonic() < deadline:
+                response += read(length - len(response))
+
+        # Make sure we got a complete, uncorrupted answer to our request
+        if (len(response) != length or response[:3] != header
+                or pack_crc(calculate_crc(response[:-2])) != response[-2:]):
+            raise modbus_tk.exceptions.ModbusInvalidResponseError("Invalid data stream response")
+
+        # Pressure A, Flow Rate A, Pressure B, Flow Rate B
+        return unpack_from(response, 3)
+
+    return ReadStream
 
 
 def ControlPumps(master):
     """ Allow the user to turn the pumps on or off. """
 
     while True:
-        cmd = raw_input("Pump A on -> onA\nPump A off -> offA\nPump B on -> onB\nPump B off -> offB\nExit -> e\n")
+        cmd = input("Pump A on -> onA\nPump A off -> offA\nPump B on -> onB\nPump B off -> offB\nExit -> e\n")
         if cmd == 'onA':
             master.execute(1, cst.WRITE_SINGLE_COIL, 0, output_value=1)
             logging.info("Pump A set to on")
@@ -291,61 +490,120 @@ def ControlPumps(master):
         else:
             print("Please try again\n")
 
-        global INTERRUPT_FLAG
-        INTERRUPT_FLAG = False
+        STOP_EVENT.clear()
 
 
 def logReadings(master, data_logger):
     """Formats the data in a tab seperated format for easy viewing and export to excel"""
 
-    global INTERRUPT_FLAG
-    while INTERRUPT_FLAG == False:
-        readings = ReadRegisters(master)
-        data_logger.info(strftime(str(readings[0]) + '\t' + str(readings[1]) + '\t' + str(readings[2]) + '\t' + str(readings[3])))
-        time.sleep(1/SAMPLE_FREQ)
+    RaisePriority()
+    try:
+        # Readings are scheduled from a fixed start time so the time it takes to
+        # read the registers doesn't add up and slowly shift the sample period
+        period = 1.0/SAMPLE_FREQ
+        read_registers = MakeStreamReader(master)
+        next_reading = monotonic()
+        count = 0
+        while True:
+            next_reading += period
+            try:
+                readings = read_registers()
+            except modbus_tk.exceptions.ModbusInvalidResponseError as exc:
+                # A late or garbled response shouldn't stop the stream, skip this reading
+                logging.warning("Reading failed: " + str(exc))
+            else:
+                if DATA_FILE is not None:
+                    DATA_FILE.write(DATA_RECORD.pack(time.time_ns(), readings[0], readings[1], readings[2], readings[3]))
+                if DATA_FILE is None or count % TEXT_LOG_EVERY == 0:
+                    # Let the logger fill in the numbers, the QueueListener thread does the formatting
+                    data_logger.info(READING_FORMAT, readings[0], readings[1], readings[2], readings[3])
+                count += 1
+            # Wait until the next reading is due, or stop right away if the user interrupts
+            if STOP_EVENT.wait(max(0, next_reading - monotonic())):
+                break
+    finally:
+        # Always undo RaisePriority, even if the stream stopped on an error
+        RestorePriority()
 
     logging.debug("User Interrupt")
-    INTERRUPT_FLAG = False
+    STOP_EVENT.clear()
     return
 
 
+def RaisePriority():
+    """Run the calling thread at a higher priority so readings are taken on time.
+
+    On Windows this also sets the system timer to 1ms (default is ~15ms) so waits end
+    when they should. Call RestorePriority() from the same thread when done."""
+
+    if sys.platform == 'win32':
+        THREAD_PRIORITY_HIGHEST = 2
+        kernel32 = ctypes.windll.kernel32
+        kernel32.SetThreadPriority(kernel32.GetCurrentThread(), THREAD_PRIORITY_HIGHEST)
+        ctypes.windll.winmm.timeBeginPeriod(1)
+    else:
+        try:
+            # Real time scheduling for this thread, needs root (or CAP_SYS_NICE) on Linux
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(10))
+        except (AttributeError, PermissionError):
+            logging.debug("Could not raise the data stream priority")
+
+
+def RestorePriority():
+    """Undo the system wide changes made by RaisePriority()"""
+
+    # The thread priority goes away with the thread but the timer resolution doesn't
+    if sys.platform == 'win32':
+        ctypes.windll.winmm.timeEndPeriod(1)
+
+
+def ReadDataFile(filename):
+    """Read back the readings saved to a '.bin' data file.
+
+    Returns a list of (time, Pressure A, Flow Rate A, Pressure B, Flow Rate B) tuples
+    with the time in seconds since the epoch. Use time.localtime() to get a clock time."""
+
+    with open(filename, 'rb') as data_file:
+        data = data_file.read()
+
+    # Ignore a partial record at the end if the program was stopped mid write
+    data = data[:len(data) - len(data) % DATA_RECORD.size]
+    return [(t * 1e-9,) + tuple(values) for t, *values in DATA_RECORD.iter_unpack(data)]
+
+
 def userInterrupt():
     """ Function waits for user input while data is being output. 
     
-    This function is called and waits at 'raw_input' until the user presses 'enter'.
-    Then the flag is set to True which tells the data output thread to stop."""
-
-    # Must use global so it works across multiple threads
-    global INTERRUPT_FLAG
+    This function is called and waits at 'input' until the user presses 'enter'.
+    Then STOP_EVENT is set which tells the data output thread to stop."""
 
     # System waits here while outputting data
-    raw_input()
-    INTERRUPT_FLAG = True
+    input()
+    STOP_EVENT.set()
 
 
 def main():
     """Main function. Where the magic happens"""
 
-    # Used to stop data output
-    global INTERRUPT_FLAG
-
     # Run the system setup
     master = setup()
     logging.info("Setup Complete")
     
     # Create a logger tag used for all data output so it can be searched for in the output file
     data_logger = logging.getLogger('DATA_OUT') # DATA_OUT is the name of the log 'tag'
+    stream = None # Thread that outputs data while streaming
 
     while True:
         print("\nWhat would you like to do?")
-        cmd = raw_input("Stream Pressure and Flow Data -> s\nList Pump Settings -> l\nControl Pumps -> c\nExit -> e\n")
+        cmd = input("Stream Pressure and Flow Data -> s\nList Pump Settings -> l\nControl Pumps -> c\nExit -> e\n")
         if cmd == 's':
-            INTERRUPT_FLAG = False
+            STOP_EVENT.clear()
             # Print a header for the data
             print("\nPress Enter for Menu\n")
             data_logger.info("Pressure A\tFlow Rate A\tPressure B\tFlow Rate B")
             # Create a new thread (parrallel process) that outputs data
-            thread.start_new_thread( logReadings, (master, data_logger)) 
+            stream = threading.Thread(target=logReadings, args=(master, data_logger), daemon=True)
+            stream.start()
         elif cmd == 'l':
             ListPumpSettings(master)
             print("Press Enter")
@@ -354,13 +612,18 @@ def main():
             print("Press Enter")
         elif cmd == 'e':
             logging.info("Now Exiting...")
+            StopLogging()
             return
         else:
             print("Command not recognized. Try again.\n")
             continue
 
-        # Wait here during data output until user triggers the INTERRUPT_FLAG
+        # Wait here during data output until user sets the STOP_EVENT
         userInterrupt()
+        # Then wait for the data output to actually stop so it's done with the port and file
+        if stream is not None:
+            stream.join()
+            stream = None
 
 
 